@@ -3,12 +3,22 @@
 """
 
 import os
+import time
+import asyncio
 import logging
-from datetime import datetime
-from typing import Optional, List
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean
+from collections import namedtuple
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from typing import Optional, List, Set, Tuple, Iterator
+from cachetools import TTLCache
+from cryptography.fernet import Fernet, InvalidToken
+from sqlalchemy import (
+    create_engine, Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey,
+    UniqueConstraint, Index, text, exists
+)
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.orm import sessionmaker, scoped_session, Session
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -17,13 +27,53 @@ logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+# Ключ шифрования паролей iCloud в БД (Fernet). Без ключа пароли хранятся как есть
+_encryption_key = os.getenv('DB_ENC_KEY')
+_fernet = Fernet(_encryption_key) if _encryption_key else None
+
+# Все токены Fernet начинаются с этого префикса (версия формата + начало метки времени)
+FERNET_TOKEN_PREFIX = 'gAAAAA'
+
+
+def encrypt_password(password: str) -> str:
+    """Шифрует пароль для хранения в БД (если задан DB_ENC_KEY)"""
+    if _fernet is None:
+        return password
+    return _fernet.encrypt(password.encode()).decode()
+
+
+def decrypt_password(stored: str) -> str:
+    """Расшифровывает пароль из БД; незашифрованные (старые) значения возвращает как есть.
+    
+    Если значение зашифровано, но ключа нет или он не подходит, выбрасывает ValueError -
+    иначе в iCloud ушел бы шифротекст вместо пароля.
+    """
+    if stored is None or not stored.startswith(FERNET_TOKEN_PREFIX):
+        return stored
+    if _fernet is None:
+        raise ValueError("Пароль iCloud в БД зашифрован, но DB_ENC_KEY не задан")
+    try:
+        return _fernet.decrypt(stored.encode()).decode()
+    except InvalidToken:
+        raise ValueError("Не удалось расшифровать пароль iCloud: проверьте DB_ENC_KEY") from None
+
 
 class User(Base):
     """Модель пользователя в БД"""
     __tablename__ = 'users'
+    __table_args__ = (
+        # Частичный индекс только по пользователям, которых проверяет планировщик
+        Index(
+            'ix_users_active', 'id',
+            postgresql_where=text(
+                "is_active AND icloud_username IS NOT NULL AND icloud_password IS NOT NULL"
+            )
+        ),
+    )
     
     id = Column(Integer, primary_key=True)
-    chat_id = Column(Integer, unique=True, nullable=False, index=True)
+    # Идентификаторы чатов Telegram не помещаются в 32 бита
+    chat_id = Column(BigInteger, unique=True, nullable=False, index=True)
     icloud_username = Column(String, nullable=True)
     icloud_password = Column(String, nullable=True)
     icloud_url = Column(String, default='https://caldav.icloud.com/')
@@ -40,15 +90,29 @@ class SentEvent(Base):
     """Модель для отслеживания отправленных событий"""
     __tablename__ = 'sent_events'
     
+    __table_args__ = (
+        # Все запросы фильтруют по паре (user_id, event_uid); уникальный индекс
+        # покрывает их целиком и защищает от повторной вставки
+        UniqueConstraint('user_id', 'event_uid', name='uq_sent_events_user_uid'),
+        # sent_at растет вместе с id, поэтому BRIN-индекс компактен и ускоряет очистку старых записей
+        Index('ix_sent_events_sent_at_brin', 'sent_at', postgresql_using='brin'),
+    )
+    
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, nullable=False, index=True)
-    event_uid = Column(String, nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    event_uid = Column(String, nullable=False)
     sent_at = Column(DateTime, default=datetime.utcnow)
     
     def __repr__(self):
         return f"<SentEvent(user_id={self.user_id}, event_uid={self.event_uid})>"
 
 
+# Облегченная запись пользователя для периодической проверки (пароль в том виде, как хранится в БД)
+ActiveUser = namedtuple(
+    'ActiveUser', ['id', 'chat_id', 'icloud_url', 'icloud_username', 'icloud_password']
+)
+
+
 class Database:
     """Класс для работы с базой данных"""
     
@@ -76,22 +140,61 @@ class Database:
             database_url = database_url.replace('postgres://', 'postgresql://', 1)
         
         logger.info(f"Подключение к БД: {database_url.split('@')[1] if '@' in database_url else 'скрыто'}")
+        if _fernet is None:
+            logger.warning("DB_ENC_KEY не задан - пароли iCloud хранятся в БД открытым текстом")
         
+        # Движок подключается к БД только при первом запросе; таблицы создаются
+        # отдельно через init_schema(), чтобы создание Database не блокировалось
         self.engine = create_engine(
             database_url, 
             echo=False,
+            pool_size=int(os.getenv('DB_POOL_SIZE', '10')),
+            max_overflow=int(os.getenv('DB_MAX_OVERFLOW', '20')),
+            pool_timeout=int(os.getenv('DB_POOL_TIMEOUT', '10')),  # Секунд ожидания свободного соединения
             pool_pre_ping=True,  # Проверяет соединение перед использованием
-            pool_recycle=3600    # Переподключается каждый час
+            pool_recycle=3600,   # Переподключается каждый час
+            pool_use_lifo=True,  # Переиспользует последние ("теплые") соединения
+            # Ограничиваем время выполнения запросов (мс)
+            connect_args={"options": f"-c statement_timeout={os.getenv('DB_STATEMENT_TIMEOUT_MS', '5000')}"}
+        )
+        # expire_on_commit=False: объекты остаются доступными после закрытия сессии
+        self.Session = scoped_session(
+            sessionmaker(autoflush=False, expire_on_commit=False, bind=self.engine)
         )
-        self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
         
-        # Создаем таблицы (с повторными попытками)
-        self.create_tables()
+        # Кеш пользователей по chat_id: учетные данные меняются редко, а get_user
+        # вызывается на каждое сообщение
+        self._user_cache = TTLCache(maxsize=10000, ttl=300)
+    
+    async def init_schema(self):
+        """Создает таблицы в БД и шифрует старые пароли, не блокируя event loop"""
+        await asyncio.to_thread(self.create_tables)
+        await asyncio.to_thread(self.encrypt_plaintext_passwords)
+    
+    def encrypt_plaintext_passwords(self) -> int:
+        """Шифрует пароли iCloud, сохраненные открытым текстом (до настройки DB_ENC_KEY)"""
+        if _fernet is None:
+            return 0
+        try:
+            with self.session_scope() as session:
+                users = session.query(User).filter(
+                    User.icloud_password.isnot(None),
+                    ~User.icloud_password.startswith(FERNET_TOKEN_PREFIX, autoescape=True)
+                ).all()
+                for user in users:
+                    user.icloud_password = encrypt_password(user.icloud_password)
+            self._user_cache.clear()
+            if users:
+                logger.info(f"Зашифрованы пароли iCloud для {len(users)} пользователей")
+            return len(users)
+        except Exception as e:
+            logger.error(f"Ошибка при шифровании сохраненных паролей: {e}")
+            return 0
     
     def create_tables(self):
-        """Создает таблицы в БД"""
-        max_retries = 3
-        retry_delay = 2
+        """Создает таблицы в БД (с повторными попытками и экспоненциальной задержкой)"""
+        max_retries = 5
+        retry_delay = 1
         
         for attempt in range(max_retries):
             try:
@@ -101,8 +204,8 @@ class Database:
             except Exception as e:
                 if attempt < max_retries - 1:
                     logger.warning(f"Попытка {attempt + 1}/{max_retries} подключения к БД не удалась: {e}")
-                    import time
                     time.sleep(retry_delay)
+                    retry_delay *= 2
                 else:
                     logger.error(f"Ошибка при создании таблиц после {max_retries} попыток: {e}")
                     logger.error("Проверьте настройки подключения к БД в переменных окружения:")
@@ -110,108 +213,161 @@ class Database:
                     logger.error("- DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD")
                     raise
     
-    def get_session(self) -> Session:
-        """Возвращает сессию БД"""
-        return self.SessionLocal()
+    @contextmanager
+    def session_scope(self) -> Iterator[Session]:
+        """Выдает сессию БД: коммитит при успехе, откатывает при ошибке"""
+        session = self.Session()
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            self.Session.remove()
     
     def get_user(self, chat_id: int) -> Optional[User]:
         """Получает пользователя по chat_id"""
-        session = self.get_session()
+        user = self._user_cache.get(chat_id)
+        if user is not None:
+            return user
         try:
-            user = session.query(User).filter(User.chat_id == chat_id).first()
+            with self.session_scope() as session:
+                user = session.query(User).filter(User.chat_id == chat_id).first()
+            if user is not None:
+                self._user_cache[chat_id] = user
             return user
         except Exception as e:
             logger.error(f"Ошибка при получении пользователя: {e}")
             return None
-        finally:
-            session.close()
     
     def create_user(self, chat_id: int) -> User:
         """Создает нового пользователя"""
-        session = self.get_session()
         try:
-            user = User(chat_id=chat_id)
-            session.add(user)
-            session.commit()
-            session.refresh(user)
+            with self.session_scope() as session:
+                user = User(chat_id=chat_id)
+                session.add(user)
+                session.flush()
+            self._user_cache.pop(chat_id, None)
             logger.info(f"Создан новый пользователь: chat_id={chat_id}")
             return user
         except Exception as e:
-            session.rollback()
             logger.error(f"Ошибка при создании пользователя: {e}")
             raise
-        finally:
-            session.close()
     
     def update_user_credentials(self, chat_id: int, icloud_username: str, 
                                 icloud_password: str, icloud_url: str = None) -> bool:
         """Обновляет учетные данные пользователя"""
-        session = self.get_session()
         try:
-            user = session.query(User).filter(User.chat_id == chat_id).first()
-            if not user:
-                user = self.create_user(chat_id)
+            with self.session_scope() as session:
+                user = session.query(User).filter(User.chat_id == chat_id).first()
+                if not user:
+                    # Создаем в той же сессии, чтобы изменения ниже попали в тот же коммит
+                    user = User(chat_id=chat_id)
+                    session.add(user)
+                    logger.info(f"Создан новый пользователь: chat_id={chat_id}")
+                
+                user.icloud_username = icloud_username
+                user.icloud_password = encrypt_password(icloud_password)
+                if icloud_url:
+                    user.icloud_url = icloud_url
+                user.updated_at = datetime.utcnow()
             
-            user.icloud_username = icloud_username
-            user.icloud_password = icloud_password
-            if icloud_url:
-                user.icloud_url = icloud_url
-            user.updated_at = datetime.utcnow()
-            
-            session.commit()
+            self._user_cache.pop(chat_id, None)
             logger.info(f"Обновлены учетные данные для пользователя: chat_id={chat_id}")
             return True
         except Exception as e:
-            session.rollback()
             logger.error(f"Ошибка при обновлении учетных данных: {e}")
             return False
-        finally:
-            session.close()
     
-    def get_active_users(self) -> List[User]:
+    def get_active_users(self) -> List[ActiveUser]:
         """Получает список активных пользователей"""
-        session = self.get_session()
         try:
-            users = session.query(User).filter(
-                User.is_active == True,
-                User.icloud_username.isnot(None),
-                User.icloud_password.isnot(None)
-            ).all()
-            return users
+            with self.session_scope() as session:
+                # Выбираем только поля, нужные для проверки календаря
+                rows = session.query(User).with_entities(*(
+                    getattr(User, field) for field in ActiveUser._fields
+                )).filter(
+                    User.is_active == True,
+                    User.icloud_username.isnot(None),
+                    User.icloud_password.isnot(None)
+                ).all()
+                return [ActiveUser(*row) for row in rows]
         except Exception as e:
             logger.error(f"Ошибка при получении активных пользователей: {e}")
             return []
-        finally:
-            session.close()
     
     def is_event_sent(self, user_id: int, event_uid: str) -> bool:
         """Проверяет, было ли событие уже отправлено"""
-        session = self.get_session()
         try:
-            sent_event = session.query(SentEvent).filter(
-                SentEvent.user_id == user_id,
-                SentEvent.event_uid == event_uid
-            ).first()
-            return sent_event is not None
+            with self.session_scope() as session:
+                # SELECT EXISTS(...) - без загрузки строки и создания ORM-объекта
+                return session.query(exists().where(
+                    SentEvent.user_id == user_id,
+                    SentEvent.event_uid == event_uid
+                )).scalar()
         except Exception as e:
             logger.error(f"Ошибка при проверке отправленного события: {e}")
             return False
-        finally:
-            session.close()
+    
+    def get_sent_event_uids(self, user_id: int, event_uids: List[str]) -> Set[str]:
+        """Возвращает множество UID из event_uids, которые уже были отправлены (одним запросом)"""
+        if not event_uids:
+            return set()
+        try:
+            with self.session_scope() as session:
+                rows = session.query(SentEvent.event_uid).filter(
+                    SentEvent.user_id == user_id,
+                    SentEvent.event_uid.in_(event_uids)
+                ).all()
+                return {row[0] for row in rows}
+        except Exception as e:
+            logger.error(f"Ошибка при проверке отправленных событий: {e}")
+            return set()
     
     def mark_event_as_sent(self, user_id: int, event_uid: str):
-        """Отмечает событие как отправленное"""
-        session = self.get_session()
+        """Отмечает событие как отправленное (без предварительной проверки - дубликат игнорируется БД)"""
+        self.mark_events_as_sent_bulk([(user_id, event_uid)])
+    
+    def mark_events_as_sent_bulk(self, rows: List[Tuple[int, str]]):
+        """Отмечает несколько событий как отправленные одной вставкой.
+        
+        rows - список пар (user_id, event_uid)
+        """
+        if not rows:
+            return
         try:
-            # Проверяем, не было ли уже отправлено
-            if not self.is_event_sent(user_id, event_uid):
-                sent_event = SentEvent(user_id=user_id, event_uid=event_uid)
-                session.add(sent_event)
-                session.commit()
-                logger.debug(f"Событие {event_uid} отмечено как отправленное для пользователя {user_id}")
+            with self.session_scope() as session:
+                stmt = insert(SentEvent).values(
+                    [{"user_id": user_id, "event_uid": event_uid} for user_id, event_uid in rows]
+                ).on_conflict_do_nothing()
+                session.execute(stmt)
+            logger.debug(f"Отмечено {len(rows)} отправленных событий")
         except Exception as e:
-            session.rollback()
-            logger.error(f"Ошибка при отметке события как отправленного: {e}")
-        finally:
-            session.close()
-
+            logger.error(f"Ошибка при отметке событий как отправленных: {e}")
+    
+    def prune_sent_events(self, retention_days: int, batch_size: int = 10000) -> int:
+        """Удаляет записи об отправленных событиях старше retention_days дней.
+        
+        Удаление идет пачками по batch_size строк, каждая в своей транзакции: так каждый
+        запрос укладывается в statement_timeout даже на большой таблице, а уже удаленное
+        не откатывается при ошибке.
+        """
+        cutoff = datetime.utcnow() - timedelta(days=retention_days)
+        total = 0
+        try:
+            while True:
+                with self.session_scope() as session:
+                    batch_ids = session.query(SentEvent.id).filter(
+                        SentEvent.sent_at < cutoff
+                    ).limit(batch_size).scalar_subquery()
+                    deleted = session.query(SentEvent).filter(
+                        SentEvent.id.in_(batch_ids)
+                    ).delete(synchronize_session=False)
+                total += deleted
+                if deleted < batch_size:
+                    break
+            logger.info(f"Удалено {total} записей об отправленных событиях старше {retention_days} дней")
+        except Exception as e:
+            logger.error(f"Ошибка при очистке отправленных событий (удалено {total}): {e}")
+        return total
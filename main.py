@@ -4,13 +4,23 @@ Telegram бот для мониторинга событий из Apple Calendar
 """
 
 import os
+import re
+import heapq
+import asyncio
 import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Union
 from enum import Enum
 
 import caldav
+from aiolimiter import AsyncLimiter
 from caldav import DAVClient
+from cachetools import TTLCache
+from caldav.elements.base import ValuedBaseElement
+from caldav.lib.error import AuthorizationError
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -20,11 +30,12 @@ from telegram.ext import (
     ConversationHandler,
     CallbackQueryHandler,
     MessageHandler,
+    AIORateLimiter,
     filters
 )
-from ics import Calendar, Event as ICSEvent
+from icalendar import Calendar as ICalendar, Event as VEvent
 
-from database import Database, User
+from database import Database, User, ActiveUser, decrypt_password
 
 # Загружаем переменные окружения (только для настроек БД и токена бота)
 load_dotenv()
@@ -40,6 +51,23 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class GetCTag(ValuedBaseElement):
+    """Свойство getctag (CalendarServer), поддерживается iCloud"""
+    tag = "{http://calendarserver.org/ns/}getctag"
+
+
+# Названия месяцев в родительном падеже для форматирования дат
+MONTHS_RU = {
+    'January': 'января', 'February': 'февраля', 'March': 'марта',
+    'April': 'апреля', 'May': 'мая', 'June': 'июня',
+    'July': 'июля', 'August': 'августа', 'September': 'сентября',
+    'October': 'октября', 'November': 'ноября', 'December': 'декабря'
+}
+MONTH_RE = re.compile("|".join(map(re.escape, MONTHS_RU)))
+
+# Блоки VTIMEZONE (правила перехода на летнее время) - самая тяжелая для разбора часть ответа iCloud
+VTIMEZONE_RE = re.compile(r"BEGIN:VTIMEZONE.*?END:VTIMEZONE\r?\n", re.S)
+
 # Состояния для ConversationHandler
 class ConversationState(Enum):
     ASK_CALENDAR = 1
@@ -51,9 +79,81 @@ class ConversationState(Enum):
 class CalendarService:
     """Сервис для работы с календарем"""
     
+    # Кеш подключений: chat_id -> (учетные данные, клиент, основной календарь, все календари).
+    # Устаревшие записи (в т.ч. ушедших пользователей) удаляются TTLCache при обращении
+    CACHE_TTL_SECONDS = 3600
+    _calendar_cache = TTLCache(maxsize=10000, ttl=CACHE_TTL_SECONDS)
+    # Кеши используются из рабочих потоков (asyncio.to_thread), а TTLCache не потокобезопасен
+    _cache_lock = threading.Lock()
+    # Блокировки по chat_id: закешированный клиент (и его requests.Session) не должен
+    # использоваться из двух потоков одновременно. Неиспользуемые блокировки удаляются сами
+    _chat_locks = weakref.WeakValueDictionary()
+    
+    # Кеш событий: (url календаря, days_ahead) -> (ctag, конец загруженного окна, события).
+    # Запись пригодна не дольше запаса окна, поэтому и живет столько же
+    EVENTS_CACHE_MARGIN = timedelta(days=1)
+    _events_cache = TTLCache(maxsize=10000, ttl=EVENTS_CACHE_MARGIN.total_seconds())
+    
+    @classmethod
+    def get_or_connect(cls, user: Union[User, ActiveUser]):
+        """Возвращает закешированное подключение к календарю пользователя или подключается заново.
+        
+        Возвращает пару (основной календарь, список всех календарей аккаунта).
+        """
+        credentials = (user.icloud_url, user.icloud_username, user.icloud_password)
+        with cls._cache_lock:
+            cached = cls._calendar_cache.get(user.chat_id)
+        if cached:
+            cached_credentials, client, calendar, calendars = cached
+            if cached_credentials == credentials:
+                return calendar, calendars
+        
+        # Пароль расшифровывается только при реальном подключении
+        client, calendar, calendars = cls.connect_to_calendar(
+            user.icloud_url, user.icloud_username, decrypt_password(user.icloud_password)
+        )
+        with cls._cache_lock:
+            cls._calendar_cache[user.chat_id] = (credentials, client, calendar, calendars)
+        return calendar, calendars
+    
+    @classmethod
+    def invalidate(cls, chat_id: int):
+        """Удаляет подключение пользователя из кеша"""
+        with cls._cache_lock:
+            cls._calendar_cache.pop(chat_id, None)
+    
+    @classmethod
+    def _chat_lock(cls, chat_id: int) -> threading.Lock:
+        """Возвращает блокировку подключения пользователя"""
+        with cls._cache_lock:
+            lock = cls._chat_locks.get(chat_id)
+            if lock is None:
+                lock = cls._chat_locks[chat_id] = threading.Lock()
+            return lock
+    
+    @classmethod
+    def call_with_calendar(cls, user: Union[User, ActiveUser], func):
+        """Вызывает func(calendar, calendars) на закешированном подключении.
+        
+        Вызовы для одного пользователя выполняются по очереди. При ошибке авторизации (401/403)
+        подключение сбрасывается и вызов повторяется один раз.
+        """
+        with cls._chat_lock(user.chat_id):
+            calendar, calendars = cls.get_or_connect(user)
+            try:
+                return func(calendar, calendars)
+            except AuthorizationError as e:
+                logger.warning(f"Ошибка авторизации для пользователя {user.chat_id}, переподключаемся: {e}")
+                cls.invalidate(user.chat_id)
+                calendar, calendars = cls.get_or_connect(user)
+                return func(calendar, calendars)
+    
     @staticmethod
     def connect_to_calendar(icloud_url: str, icloud_username: str, icloud_password: str):
-        """Подключается к iCloud календарю"""
+        """Подключается к iCloud календарю.
+        
+        Возвращает (клиент, основной календарь, список всех календарей аккаунта).
+        """
         try:
             logger.info(f"Подключение к iCloud календарю для {icloud_username}...")
             client = DAVClient(
@@ -102,116 +202,199 @@ class CalendarService:
                 logger.warning(f"Используется первый доступный календарь: {calendar.name}")
             
             logger.info(f"Успешно подключено к календарю: {calendar.name}")
-            return client, calendar
+            return client, calendar, calendars
             
         except Exception as e:
             logger.error(f"Ошибка при подключении к календарю: {e}")
             raise
     
     @staticmethod
-    def get_events(calendar, days_ahead: int = 7) -> List[ICSEvent]:
-        """Получает события из календаря на указанное количество дней вперед"""
+    def get_ctag(calendar) -> Optional[str]:
+        """Возвращает ctag календаря (меняется при любом изменении в календаре) или None"""
+        try:
+            return calendar.get_property(GetCTag())
+        except AuthorizationError:
+            raise
+        except Exception as e:
+            logger.debug(f"Не удалось получить ctag календаря '{calendar.name}': {e}")
+            return None
+    
+    @staticmethod
+    def _to_datetime(value) -> datetime:
+        """Приводит DTSTART/DTEND к timezone-aware datetime (дата события на весь день - к полуночи)"""
+        if not isinstance(value, datetime):
+            value = datetime.combine(value, datetime.min.time())
+        if value.tzinfo is None:
+            from datetime import timezone
+            value = value.replace(tzinfo=timezone.utc)
+        return value
+    
+    @staticmethod
+    def event_start(event: VEvent) -> datetime:
+        """Возвращает время начала события (timezone-aware)"""
+        return CalendarService._to_datetime(event.decoded('DTSTART'))
+    
+    @staticmethod
+    def event_duration(event: VEvent) -> Optional[timedelta]:
+        """Возвращает длительность события (из DTEND или DURATION)"""
+        if 'DTEND' in event:
+            return CalendarService._to_datetime(event.decoded('DTEND')) - CalendarService.event_start(event)
+        if 'DURATION' in event:
+            return event.decoded('DURATION')
+        return None
+    
+    @staticmethod
+    def event_summary(event: VEvent) -> str:
+        """Возвращает название события"""
+        return str(event.get('SUMMARY', ''))
+    
+    @staticmethod
+    def parse_vevents(ics_data: str) -> List[VEvent]:
+        """Разбирает VEVENT-компоненты из iCalendar, пропуская блоки VTIMEZONE.
+        
+        iCloud использует TZID из базы Olson, которые распознаются и без VTIMEZONE. Если какой-то
+        TZID без VTIMEZONE распознать не удалось, данные разбираются целиком.
+        """
+        vevents = ICalendar.from_ical(VTIMEZONE_RE.sub("", ics_data)).walk('VEVENT')
+        for vevent in vevents:
+            dtstart = vevent.get('DTSTART')
+            if (dtstart is not None and 'TZID' in dtstart.params
+                    and isinstance(dtstart.dt, datetime) and dtstart.dt.tzinfo is None):
+                return ICalendar.from_ical(ics_data).walk('VEVENT')
+        return vevents
+    
+    @classmethod
+    def get_events(cls, calendar, days_ahead: int = 7, limit: Optional[int] = None,
+                   sort: bool = True, now: Optional[datetime] = None) -> List[VEvent]:
+        """Получает события из календаря на указанное количество дней вперед.
+        
+        limit - вернуть только столько ближайших событий; sort=False - не сортировать результат;
+        now - момент отсчета (по умолчанию текущее время).
+        Загруженные события кешируются вместе с ctag календаря: пока ctag не изменился,
+        события повторно не скачиваются и не парсятся.
+        """
         try:
-            now = datetime.now()
+            if now is None:
+                now = datetime.now()
             end_date = now + timedelta(days=days_ahead)
             
-            logger.debug(f"Поиск событий с {now} по {end_date} в календаре '{calendar.name}'")
-            
-            # Получаем события из календаря
-            # Пробуем разные форматы даты
-            try:
-                events = calendar.search(
-                    start=now,
-                    end=end_date,
-                    event=True
-                )
-            except Exception as e1:
-                logger.debug(f"Попытка 1 не удалась: {e1}, пробуем с date()")
-                try:
-                    events = calendar.search(
-                        start=now.date(),
-                        end=end_date.date(),
-                        event=True
-                    )
-                except Exception as e2:
-                    logger.debug(f"Попытка 2 не удалась: {e2}, пробуем без параметров")
-                    # Пробуем получить все события и фильтровать вручную
-                    events = calendar.events()
-            
-            logger.info(f"Получено {len(events)} сырых событий из календаря '{calendar.name}'")
+            cache_key = (str(calendar.url), days_ahead)
+            ctag = cls.get_ctag(calendar)
+            with cls._cache_lock:
+                cached = cls._events_cache.get(cache_key)
+            if ctag is not None and cached and cached[0] == ctag and cached[1] >= end_date:
+                logger.debug(f"Календарь '{calendar.name}' не изменился, используем кеш событий")
+                candidates = cached[2]
+            else:
+                # Загружаем с запасом, чтобы кеш оставался пригодным по мере сдвига окна
+                fetch_end = end_date + cls.EVENTS_CACHE_MARGIN
+                candidates = cls._fetch_events(calendar, now, fetch_end)
+                if ctag is not None:
+                    with cls._cache_lock:
+                        cls._events_cache[cache_key] = (ctag, fetch_end, candidates)
             
-            parsed_events = []
-            for idx, event in enumerate(events):
-                try:
-                    # Парсим событие из iCalendar формата
-                    ics_data = event.data
-                    if not ics_data:
-                        logger.warning(f"Событие {idx} не содержит данных")
-                        continue
-                    
-                    calendar_obj = Calendar(ics_data)
-                    logger.debug(f"Парсинг календаря {idx}, найдено {len(calendar_obj.events)} событий в iCalendar")
-                    for ics_event in calendar_obj.events:
-                        try:
-                            # Проверяем, что событие в нужном диапазоне дат
-                            event_start = ics_event.begin.datetime
-                            
-                            # Приводим к одному формату (timezone-aware)
-                            if event_start.tzinfo is None:
-                                # Если событие без timezone, считаем что оно в локальном времени
-                                from datetime import timezone
-                                event_start = event_start.replace(tzinfo=timezone.utc)
-                            
-                            # Приводим now и end_date к timezone-aware если нужно
-                            if now.tzinfo is None:
-                                from datetime import timezone
-                                now_tz = now.replace(tzinfo=timezone.utc)
-                            else:
-                                now_tz = now
-                            
-                            if end_date.tzinfo is None:
-                                from datetime import timezone
-                                end_date_tz = end_date.replace(tzinfo=timezone.utc)
-                            else:
-                                end_date_tz = end_date
-                            
-                            # Сравниваем даты
-                            if event_start >= now_tz and event_start <= end_date_tz:
-                                parsed_events.append(ics_event)
-                                logger.info(f"✓ Добавлено событие: '{ics_event.name}' на {event_start}")
-                            else:
-                                logger.debug(f"✗ Событие '{ics_event.name}' на {event_start} вне диапазона ({now_tz} - {end_date_tz})")
-                        except Exception as e:
-                            logger.warning(f"Ошибка при обработке события '{ics_event.name if hasattr(ics_event, 'name') else 'unknown'}': {e}", exc_info=True)
-                            continue
-                except Exception as e:
-                    logger.warning(f"Ошибка при парсинге события {idx}: {e}")
-                    continue
+            from datetime import timezone
+            now_tz = now.replace(tzinfo=timezone.utc)
+            end_date_tz = end_date.replace(tzinfo=timezone.utc)
+            parsed_events = [
+                e for e in candidates
+                if now_tz <= cls.event_start(e) <= end_date_tz
+            ]
             
             # Сортируем по времени начала (безопасное сравнение с timezone)
-            def safe_sort_key(event):
-                dt = event.begin.datetime
-                if dt.tzinfo is None:
-                    from datetime import timezone
-                    return dt.replace(tzinfo=timezone.utc)
-                return dt
-            
-            parsed_events.sort(key=safe_sort_key)
+            if limit is not None:
+                parsed_events = heapq.nsmallest(limit, parsed_events, key=cls.event_start)
+            elif sort:
+                parsed_events.sort(key=cls.event_start)
             logger.info(f"Найдено {len(parsed_events)} событий на ближайшие {days_ahead} дней в календаре '{calendar.name}'")
             
             return parsed_events
             
+        except AuthorizationError:
+            raise
         except Exception as e:
             logger.error(f"Ошибка при получении событий: {e}", exc_info=True)
             return []
     
     @staticmethod
-    def get_events_from_all_calendars(client, days_ahead: int = 7) -> List[ICSEvent]:
-        """Получает события из всех календарей (кроме Напоминаний)"""
+    def _fetch_events(calendar, now: datetime, fetch_end: datetime) -> List[VEvent]:
+        """Загружает и парсит события календаря в диапазоне [now, fetch_end]"""
+        logger.debug(f"Поиск событий с {now} по {fetch_end} в календаре '{calendar.name}'")
+        
+        # Получаем события из календаря
+        # Пробуем разные форматы даты
+        try:
+            events = calendar.search(
+                start=now,
+                end=fetch_end,
+                event=True
+            )
+        except Exception as e1:
+            logger.debug(f"Попытка 1 не удалась: {e1}, пробуем с date()")
+            try:
+                events = calendar.search(
+                    start=now.date(),
+                    end=fetch_end.date(),
+                    event=True
+                )
+            except Exception as e2:
+                logger.debug(f"Попытка 2 не удалась: {e2}, пробуем без параметров")
+                # Пробуем получить все события и фильтровать вручную
+                events = calendar.events()
+        
+        logger.info(f"Получено {len(events)} сырых событий из календаря '{calendar.name}'")
+        
+        parsed_events = []
+        for idx, event in enumerate(events):
+            try:
+                # Парсим событие из iCalendar формата
+                ics_data = event.data
+                if not ics_data:
+                    logger.warning(f"Событие {idx} не содержит данных")
+                    continue
+                
+                for ics_event in CalendarService.parse_vevents(ics_data):
+                    try:
+                        # Проверяем, что событие в нужном диапазоне дат (timezone-aware)
+                        event_start = CalendarService.event_start(ics_event)
+                        
+                        # Приводим now и fetch_end к timezone-aware если нужно
+                        if now.tzinfo is None:
+                            from datetime import timezone
+                            now_tz = now.replace(tzinfo=timezone.utc)
+                        else:
+                            now_tz = now
+                        
+                        if fetch_end.tzinfo is None:
+                            from datetime import timezone
+                            end_tz = fetch_end.replace(tzinfo=timezone.utc)
+                        else:
+                            end_tz = fetch_end
+                        
+                        # Сравниваем даты
+                        if event_start >= now_tz and event_start <= end_tz:
+                            parsed_events.append(ics_event)
+                            logger.info(f"✓ Добавлено событие: '{CalendarService.event_summary(ics_event)}' на {event_start}")
+                        else:
+                            logger.debug(f"✗ Событие '{CalendarService.event_summary(ics_event)}' на {event_start} вне диапазона ({now_tz} - {end_tz})")
+                    except Exception as e:
+                        logger.warning(f"Ошибка при обработке события '{CalendarService.event_summary(ics_event) or 'unknown'}': {e}", exc_info=True)
+                        continue
+            except Exception as e:
+                logger.warning(f"Ошибка при парсинге события {idx}: {e}")
+                continue
+        
+        return parsed_events
+    
+    @staticmethod
+    def get_events_from_all_calendars(calendars, days_ahead: int = 7,
+                                      limit: Optional[int] = None) -> List[VEvent]:
+        """Получает события из всех календарей (кроме Напоминаний)
+        
+        calendars - список календарей аккаунта (из кеша подключения);
+        limit - вернуть только столько ближайших событий
+        """
         try:
-            principal = client.principal()
-            calendars = principal.calendars()
-            
             all_events = []
             for calendar in calendars:
                 cal_name_lower = calendar.name.lower()
@@ -219,71 +402,67 @@ class CalendarService:
                 if 'напоминания' in cal_name_lower or 'reminders' in cal_name_lower:
                     continue
                 
-                events = CalendarService.get_events(calendar, days_ahead)
+                events = CalendarService.get_events(calendar, days_ahead, limit=limit)
                 all_events.extend(events)
             
             # Сортируем все события по времени (безопасное сравнение с timezone)
-            def safe_sort_key(event):
-                dt = event.begin.datetime
-                if dt.tzinfo is None:
-                    from datetime import timezone
-                    return dt.replace(tzinfo=timezone.utc)
-                return dt
-            
-            all_events.sort(key=safe_sort_key)
+            if limit is not None:
+                all_events = heapq.nsmallest(limit, all_events, key=CalendarService.event_start)
+            else:
+                all_events.sort(key=CalendarService.event_start)
             logger.info(f"Всего найдено {len(all_events)} событий из всех календарей")
             
             return all_events
             
+        except AuthorizationError:
+            raise
         except Exception as e:
             logger.error(f"Ошибка при получении событий из всех календарей: {e}")
             return []
     
     @staticmethod
-    def format_event_message(event: ICSEvent) -> str:
+    def format_event_message(event: VEvent) -> str:
         """Форматирует событие для отправки в Telegram"""
         lines = ["📅 Новое событие в календаре:", ""]
         
         # Название
-        if event.name:
-            lines.append(f"Название: {event.name}")
+        name = CalendarService.event_summary(event)
+        if name:
+            lines.append(f"Название: {name}")
         
         # Дата и время
-        start_time = event.begin.datetime
-        if event.duration:
-            end_time = start_time + event.duration
+        start_time = CalendarService.event_start(event)
+        duration = CalendarService.event_duration(event)
+        if duration:
+            end_time = start_time + duration
             time_str = f"{start_time.strftime('%d %B, %H:%M')}–{end_time.strftime('%H:%M')}"
         else:
             time_str = start_time.strftime('%d %B, %H:%M')
         
         # Форматируем месяц на русском
-        months_ru = {
-            'January': 'января', 'February': 'февраля', 'March': 'марта',
-            'April': 'апреля', 'May': 'мая', 'June': 'июня',
-            'July': 'июля', 'August': 'августа', 'September': 'сентября',
-            'October': 'октября', 'November': 'ноября', 'December': 'декабря'
-        }
-        for en, ru in months_ru.items():
-            time_str = time_str.replace(en, ru)
+        time_str = MONTH_RE.sub(lambda m: MONTHS_RU[m.group(0)], time_str)
         
         lines.append(f"Когда: {time_str}")
         
         # Место
-        if event.location:
-            lines.append(f"Место: {event.location}")
+        location = event.get('LOCATION')
+        if location:
+            lines.append(f"Место: {location}")
         
         # Описание
-        if event.description:
-            lines.append(f"Описание: {event.description}")
+        description = event.get('DESCRIPTION')
+        if description:
+            lines.append(f"Описание: {description}")
         
         return "\n".join(lines)
     
     @staticmethod
-    def get_event_id(event: ICSEvent) -> str:
+    def get_event_id(event: VEvent) -> str:
         """Генерирует уникальный ID для события"""
-        if event.uid:
-            return event.uid
-        return f"{event.name}_{event.begin.isoformat()}"
+        uid = event.get('UID')
+        if uid:
+            return str(uid)
+        return f"{CalendarService.event_summary(event)}_{CalendarService.event_start(event).isoformat()}"
 
 
 # Глобальные объекты
@@ -293,6 +472,25 @@ telegram_token = os.getenv('TELEGRAM_TOKEN')
 if not telegram_token:
     raise ValueError("TELEGRAM_TOKEN должен быть указан в .env файле")
 
+# Горизонт периодической проверки событий в днях
+CHECK_DAYS_AHEAD = 7
+
+# Ограничение на количество одновременных проверок календарей
+caldav_semaphore = asyncio.Semaphore(int(os.getenv('CALDAV_CONCURRENCY', '8')))
+
+# Ограничители частоты уведомлений по чатам: не больше 1 сообщения в секунду в один чат.
+# AIORateLimiter ограничивает по чатам только группы и каналы, а не личные чаты
+chat_limiters = TTLCache(maxsize=10000, ttl=3600)
+
+
+async def send_limited_message(application: Application, chat_id: int, text: str):
+    """Отправляет сообщение, соблюдая лимит 1 сообщение в секунду для чата"""
+    limiter = chat_limiters.get(chat_id)
+    if limiter is None:
+        limiter = chat_limiters[chat_id] = AsyncLimiter(1, 1)
+    async with limiter:
+        return await application.bot.send_message(chat_id=chat_id, text=text)
+
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
@@ -417,7 +615,8 @@ async def receive_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Пытаемся подключиться к календарю для проверки
     try:
-        client, calendar = CalendarService.connect_to_calendar(
+        client, calendar, calendars = await asyncio.to_thread(
+            CalendarService.connect_to_calendar,
             'https://caldav.icloud.com/',
             username,
             password
@@ -480,44 +679,23 @@ async def get_next_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        # Подключаемся к календарю
-        client, calendar = CalendarService.connect_to_calendar(
-            user.icloud_url,
-            user.icloud_username,
-            user.icloud_password
-        )
-        
         # Получаем события из всех календарей (кроме Напоминаний)
-        events = CalendarService.get_events_from_all_calendars(client, days_ahead=30)
+        events = await asyncio.to_thread(
+            CalendarService.call_with_calendar,
+            user,
+            lambda calendar, calendars: CalendarService.get_events_from_all_calendars(
+                calendars, days_ahead=30, limit=3
+            )
+        )
         
         if not events:
             message = "Событий не найдено."
         else:
-            # Берем ближайшие 3 события (безопасное сравнение с timezone)
-            now = datetime.now()
-            from datetime import timezone
-            if now.tzinfo is None:
-                now_tz = now.replace(tzinfo=timezone.utc)
-            else:
-                now_tz = now
-            
-            upcoming_events = []
-            for e in events:
-                event_dt = e.begin.datetime
-                if event_dt.tzinfo is None:
-                    event_dt = event_dt.replace(tzinfo=timezone.utc)
-                if event_dt > now_tz:
-                    upcoming_events.append(e)
-                    if len(upcoming_events) >= 3:
-                        break
-            
-            if not upcoming_events:
-                message = "Ближайших событий не найдено."
-            else:
-                messages = []
-                for event in upcoming_events:
-                    messages.append(CalendarService.format_event_message(event))
-                message = "\n\n".join(messages)
+            # Уже не более 3 ближайших событий, отсортированных по времени
+            messages = []
+            for event in events:
+                messages.append(CalendarService.format_event_message(event))
+            message = "\n\n".join(messages)
         
         if update.callback_query:
             await update.callback_query.edit_message_text(message)
@@ -541,53 +719,64 @@ async def next_events_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     await get_next_events(update, context)
 
 
-async def check_events_for_user(user: User, application: Application):
+async def check_events_for_user(user: ActiveUser, application: Application):
     """Проверяет события для конкретного пользователя"""
     try:
-        # Подключаемся к календарю
-        client, calendar = CalendarService.connect_to_calendar(
-            user.icloud_url,
-            user.icloud_username,
-            user.icloud_password
-        )
+        # Один момент времени на всю проверку: и для окна поиска, и для фильтрации ниже
+        now = datetime.now()
+        
+        # Получаем события (caldav синхронный, поэтому запросы выполняются в отдельном потоке).
+        # Семафор ограничивает только запросы к CalDAV: отправка уведомлений с лимитом
+        # 1 сообщение в секунду не должна занимать слот проверки календарей
+        async with caldav_semaphore:
+            events = await asyncio.to_thread(
+                CalendarService.call_with_calendar,
+                user,
+                lambda calendar, calendars: CalendarService.get_events(
+                    calendar, days_ahead=CHECK_DAYS_AHEAD, sort=False, now=now
+                )
+            )
         
-        # Получаем события
-        events = CalendarService.get_events(calendar, days_ahead=7)
+        # Проверяем, какие события уже были отправлены (одним запросом)
+        event_ids = [CalendarService.get_event_id(event) for event in events]
+        sent_ids = db.get_sent_event_uids(user.id, event_ids)
         
         # Фильтруем только новые события
+        from datetime import timezone
+        now_tz = now.replace(tzinfo=timezone.utc)
         new_events = []
-        for event in events:
-            event_id = CalendarService.get_event_id(event)
-            
-            # Проверяем, было ли событие уже отправлено
-            if not db.is_event_sent(user.id, event_id):
+        for event, event_id in zip(events, event_ids):
+            if event_id not in sent_ids:
                 # Проверяем, что событие еще не началось или началось недавно
-                start_time = event.begin.datetime
-                now = datetime.now()
-                from datetime import timezone
-                if start_time.tzinfo is None:
-                    start_time = start_time.replace(tzinfo=timezone.utc)
-                if now.tzinfo is None:
-                    now = now.replace(tzinfo=timezone.utc)
-                time_diff = start_time - now
+                start_time = CalendarService.event_start(event)
+                time_diff = start_time - now_tz
                 if time_diff.total_seconds() > -3600:  # Не старше часа
                     new_events.append(event)
         
-        # Отправляем новые события
-        for event in new_events:
-            message = CalendarService.format_event_message(event)
-            await application.bot.send_message(
-                chat_id=user.chat_id,
-                text=message
-            )
-            
-            # Отмечаем событие как отправленное
-            event_id = CalendarService.get_event_id(event)
-            db.mark_event_as_sent(user.id, event_id)
+        # Отправляем новые события по времени начала; ограничитель чата выпускает их по одному
+        # в секунду в порядке постановки в очередь
+        new_events.sort(key=CalendarService.event_start)
+        results = await asyncio.gather(
+            *(send_limited_message(
+                application,
+                user.chat_id,
+                CalendarService.format_event_message(event)
+            ) for event in new_events),
+            return_exceptions=True
+        )
+        
+        # Отмечаем успешно отправленные события одной вставкой
+        sent_rows = []
+        for event, result in zip(new_events, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Не удалось отправить событие пользователю {user.chat_id}: {result}")
+            else:
+                sent_rows.append((user.id, CalendarService.get_event_id(event)))
+        db.mark_events_as_sent_bulk(sent_rows)
+        
+        if sent_rows:
+            logger.info(f"Отправлено {len(sent_rows)} новых событий пользователю {user.chat_id}")
         
-        if new_events:
-            logger.info(f"Отправлено {len(new_events)} новых событий пользователю {user.chat_id}")
-            
     except Exception as e:
         logger.error(f"Ошибка при проверке событий для пользователя {user.chat_id}: {e}")
 
@@ -603,13 +792,29 @@ async def check_events_job(context: ContextTypes.DEFAULT_TYPE):
         logger.debug("Нет активных пользователей для проверки")
         return
     
-    # Проверяем события для каждого пользователя
-    for user in users:
-        await check_events_for_user(user, context.application)
+    # Проверяем события для всех пользователей параллельно (число одновременных проверок
+    # ограничено caldav_semaphore)
+    await asyncio.gather(
+        *(check_events_for_user(user, context.application) for user in users)
+    )
     
     logger.info(f"Проверка событий завершена для {len(users)} пользователей")
 
 
+async def prune_sent_events_job(context: ContextTypes.DEFAULT_TYPE):
+    """Задача для удаления старых записей об отправленных событиях"""
+    retention_days = int(os.getenv('SENT_EVENTS_RETENTION_DAYS', '90'))
+    # Записи о событиях внутри окна проверки удалять нельзя - иначе они будут отправлены повторно
+    min_retention_days = CHECK_DAYS_AHEAD + 1
+    if retention_days < min_retention_days:
+        logger.error(
+            f"SENT_EVENTS_RETENTION_DAYS={retention_days} меньше горизонта проверки, "
+            f"используется {min_retention_days}"
+        )
+        retention_days = min_retention_days
+    await asyncio.to_thread(db.prune_sent_events, retention_days)
+
+
 def main():
     """Основная функция запуска бота"""
     try:
@@ -617,7 +822,13 @@ def main():
             raise ValueError("TELEGRAM_TOKEN должен быть указан в .env файле")
         
         # Создаем приложение Telegram
-        application = Application.builder().token(telegram_token).build()
+        # AIORateLimiter соблюдает общий лимит Telegram и повторяет запросы после ответа 429
+        application = (
+            Application.builder()
+            .token(telegram_token)
+            .rate_limiter(AIORateLimiter(max_retries=3))
+            .build()
+        )
         
         # Создаем ConversationHandler для настройки календаря
         conv_handler = ConversationHandler(
@@ -649,6 +860,14 @@ def main():
         
         async def post_init(application: Application) -> None:
             """Инициализация после запуска бота"""
+            # Пул потоков для синхронных запросов к CalDAV (asyncio.to_thread)
+            asyncio.get_running_loop().set_default_executor(
+                ThreadPoolExecutor(max_workers=int(os.getenv('CALDAV_MAX_WORKERS', '32')))
+            )
+            
+            # Создаем/проверяем таблицы БД до запуска периодических задач
+            await db.init_schema()
+            
             # Запускаем периодическую проверку событий
             application.job_queue.run_repeating(
                 check_events_job,
@@ -656,6 +875,14 @@ def main():
                 first=10,  # Первый запуск через 10 секунд
                 name='check_events'
             )
+            
+            # Раз в сутки очищаем старые записи об отправленных событиях
+            application.job_queue.run_repeating(
+                prune_sent_events_job,
+                interval=24 * 60 * 60,
+                first=60,
+                name='prune_sent_events'
+            )
             logger.info(f"Планировщик запущен. Проверка каждые {check_interval} минут.")
         
         # Устанавливаем post_init callback